@@ -67,7 +67,7 @@ setup(
         'pyyaml',
         'qpsolvers',
         'scipy',
-        'scikit-image',
+        'tifffile>=2022.7.28',
     ],
 
     # List additional groups of dependencies here (e.g. development
@@ -2,7 +2,7 @@ import sys
 import argparse
 
 import numpy as np
-import skimage.external.tifffile as tiff
+import tifffile as tiff
 
 from .normxcorr import normxcorr2_fftw
 from .io.inputfile import InputFile
@@ -73,11 +73,11 @@ def stitch(aname, bname, z_frame, axis, overlap, max_shift_z=20,
         bframe = np.rot90(bframe, axes=(-1, -2))
     b_roi = bframe[..., :overlap - max_shift_y, max_shift_x:-max_shift_x]
 
-    tiff.imsave('aslice.tiff', a_roi.astype(np.float32))
-    tiff.imsave('bframe.tiff', b_roi.astype(np.float32))
+    tiff.imwrite('aslice.tiff', a_roi.astype(np.float32))
+    tiff.imwrite('bframe.tiff', b_roi.astype(np.float32))
 
     xcorr = normxcorr2_fftw(a_roi, b_roi)
-    tiff.imsave('xcorr.tiff', xcorr.astype(np.float32))
+    tiff.imwrite('xcorr.tiff', xcorr.astype(np.float32))
 
     shift = list(np.unravel_index(np.argmax(xcorr), xcorr.shape))
     score = xcorr[tuple(shift)]
@@ -110,7 +110,7 @@ def stitch(aname, bname, z_frame, axis, overlap, max_shift_z=20,
     if axis == 2:
         fused = np.rot90(fused, axes=(-1, -2), k=3)
 
-    tiff.imsave('fused.tiff', fused.astype(np.float32))
+    tiff.imwrite('fused.tiff', fused.astype(np.float32))
     return shift + [score]
 
 
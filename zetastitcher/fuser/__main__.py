@@ -57,9 +57,9 @@ def parse_args():
     group.add_argument('--ch', type=int, default=-1, dest='channel',
                        help='channel')
 
-    group.add_argument('-c', type=str, default=0, dest='compression',
+    group.add_argument('-c', type=str, default=None, dest='compression',
                        choices=[str(i) for i in range(10)] + ['lzma'],
-                       help='compression')
+                       help='compression (0: none)')
 
     group.add_argument('--zmin', type=float, default=0,
                        help='start frame (in your units)')
@@ -174,7 +174,7 @@ def preprocess_and_check_args(args):
 
     try:
         args.compression = int(args.compression)
-    except ValueError:
+    except (TypeError, ValueError):
         pass
 
 
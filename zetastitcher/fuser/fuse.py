@@ -6,17 +6,99 @@ from functools import lru_cache
 
 from .lcd_numbers import numbers, canvas_shape
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+#: assumed last-level cache size, used to size cache-resident work units
+L3_CACHE_BYTES = 32 * 2 ** 20
+
 
 def flatten(my_list):
     return [item for sublist in my_list for item in sublist]
 
 
-def to_dtype(x, dtype):
-    if x.dtype == dtype:
-        return x
-    if np.issubdtype(dtype, np.integer):
-        np.rint(x, x)
-    return x.astype(dtype, copy=False)
+if numba is not None:
+    # note: no parallel=True here. These kernels run on the fuse thread and
+    # some numba threading layers (e.g. tbb) hang at interpreter shutdown
+    # when a parallel region is entered from a non-main thread. nogil is
+    # enough: the blend overlaps with the decoding workers anyway
+    @numba.njit(nogil=True)
+    def _blend_add3(dest, src, factor):
+        # dest, src: (Z, Y, X) views; factor: (Y, X). The product is rounded
+        # to float32 before accumulating, like the numpy fallback does
+        for z in range(dest.shape[0]):
+            for y in range(dest.shape[1]):
+                for x in range(dest.shape[2]):
+                    dest[z, y, x] += np.float32(src[z, y, x] * factor[y, x])
+
+    @numba.njit(nogil=True)
+    def _add3(dest, src):
+        for z in range(dest.shape[0]):
+            for y in range(dest.shape[1]):
+                for x in range(dest.shape[2]):
+                    dest[z, y, x] += src[z, y, x]
+
+
+def _accumulate(dest, src, factor, channels_last=False):
+    """Add `src` (optionally scaled by `factor`) into `dest`.
+
+    Runs in nogil numba kernels, so the producer threads keep decoding
+    while the blend runs."""
+    if dest.ndim == 4:
+        if channels_last:
+            for c in range(dest.shape[-1]):
+                _accumulate(dest[..., c], src[..., c], factor)
+        else:
+            for c in range(dest.shape[1]):
+                _accumulate(dest[:, c], src[:, c], factor)
+        return
+    if factor is None:
+        _add3(dest, src)
+    else:
+        _blend_add3(dest, src, factor)
+
+
+if numba is not None:
+    # no parallel region here either: this runs on the writer thread.
+    # No fastmath either, or the NaN check below would be optimized away
+    @numba.njit(nogil=True)
+    def _round_cast(src, dst):
+        for i in range(src.size):
+            v = src[i]
+            if v != v:
+                # NaN, like at the zero-weight border pixels: the numpy
+                # path (rint + unsafe cast) turns these into 0
+                dst[i] = 0
+            elif v >= 0:
+                dst[i] = v + 0.5
+            else:
+                dst[i] = v - 0.5
+
+
+def to_dtype(x, dtype, out=None):
+    """Round (for integer dtypes) and cast `x` to `dtype`.
+
+    When `out` is given, round and cast are fused in a single pass over the
+    input, storing into the preallocated `out` array.
+    """
+    if out is None:
+        if x.dtype == dtype:
+            return x
+        if np.issubdtype(dtype, np.integer):
+            np.rint(x, x)
+        return x.astype(dtype, copy=False)
+
+    if (numba is not None and np.issubdtype(dtype, np.integer)
+            and x.flags['C_CONTIGUOUS'] and out.flags['C_CONTIGUOUS']):
+        _round_cast(x.ravel(), out.ravel())
+    else:
+        if np.issubdtype(dtype, np.integer):
+            np.rint(x, x)
+        np.copyto(out, x, casting='unsafe')
+    return out
 
 
 @lru_cache()
@@ -76,27 +158,36 @@ def squircle_alpha(height, width):
     return squircle
 
 
-def fuse_queue(q, dest, frame_shape, debug=False):
+def fuse_queue(q, dest, frame_shape, debug=False, free_slots=None,
+               channels_last=False):
     """Fuse a queue of images along Y, optionally applying padding.
 
     Parameters
     ----------
     q : :py:class:`queue.Queue`
         A queue containing elements in the form ``[hyperslice, index, zfrom,
-        offset_idx, top_left, overlaps]`` where `hyperslice` is a
+        offset_idx, top_left, overlaps, slot]`` where `hyperslice` is a
         `numpy.ndarray`, `index` and `zfrom` are the tile index in the
         pandas dataframe and the starting frame in the original stack (these
         two are used for debugging purposes only), `offset_idx` is a
         tuple of :class:`slice` objects with the slice offset inside a single
         stack, `top_left` is a list specifying the image position in the form
-        ``[Z, Y, X]``, `overlaps` is a :class:`pandas.DataFrame` specifying
-        overlaps with adjacent tiles.
+        ``[Z, Y, X]``, `overlaps` is a :class:`numpy.recarray` with fields
+        `Z_from`, `Z_to`, `Y_from`, `Y_to`, `X_from`, `X_to` specifying
+        overlaps with adjacent tiles, `slot` is the index of the buffer
+        backing `hyperslice` (may be `None`), given back through
+        `free_slots` once the slice has been accumulated.
     frame_shape : tuple
         Shape of a stack plane (XY).
     dest : :class:`numpy.ndarray`
         Destination array.
     debug: bool
         Whether to overlay debug information (tile edges and numbers).
+    free_slots : :py:class:`queue.Queue`
+        Queue of free buffer slot indices.
+    channels_last : bool
+        Whether multichannel hyperslices and `dest` are laid out as
+        ``(Z, Y, X, C)`` instead of ``(Z, C, Y, X)``.
     """
 
     while True:
@@ -105,22 +196,30 @@ def fuse_queue(q, dest, frame_shape, debug=False):
         if got is None:
             break
 
-        slice, index_dbg, zfrom_dbg, sl, pos, overlaps = got
+        slice, index_dbg, zfrom_dbg, sl, pos, overlaps, slot = got
 
+        is_cl = channels_last and slice.ndim == 4
 
         z_from = pos[0]
         z_to = z_from + slice.shape[0]
 
+        frame_height = slice.shape[1] if is_cl else slice.shape[-2]
+        frame_width = slice.shape[2] if is_cl else slice.shape[-1]
+
         y_from = pos[1]
-        y_to = y_from + slice.shape[-2]
+        y_to = y_from + frame_height
 
         x_from = pos[2]
-        x_to = x_from + slice.shape[-1]
+        x_to = x_from + frame_width
+
+        nz = slice.shape[0]
 
+        # build a list of (zfrom, zto, factor) segments covering the whole
+        # slice; factor is None where no blending is needed
+        segments = []
         if overlaps is not None:
-            z = np.array(flatten(overlaps[['Z_from', 'Z_to']].values))
-            z = np.unique(z)
-            z = np.sort(z)
+            z = np.concatenate((overlaps.Z_from, overlaps.Z_to))
+            z = np.unique(z)  # also sorts
 
             xy_weights = squircle_alpha(*frame_shape)
 
@@ -131,14 +230,18 @@ def fuse_queue(q, dest, frame_shape, debug=False):
                 pass
 
             for zfrom, zto in z_list:
+                zstop = nz if zto is None else min(int(zto), nz)
+                if zfrom >= zstop:
+                    continue
+
                 sums = np.copy(xy_weights)
-                condition = (overlaps['Z_from'] <= zfrom)
+                condition = (overlaps.Z_from <= zfrom)
                 if zto is not None:
-                    condition = condition & (zto <= (overlaps['Z_to']))
+                    condition = condition & (zto <= overlaps.Z_to)
                 else:
-                    condition = condition & (overlaps['Z_to'] >= z_to)
+                    condition = condition & (overlaps.Z_to >= z_to)
 
-                for _, row in overlaps[condition].iterrows():
+                for row in overlaps[condition]:
                     width = row.X_to - row.X_from
                     height = row.Y_to - row.Y_from
                     area = width * height
@@ -156,57 +259,125 @@ def fuse_queue(q, dest, frame_shape, debug=False):
                                             row.X_from:row.X_to]
                     sums[xy_index] += w
 
-                if zto is None:
-                    slice_index = np.index_exp[zfrom:, ...]
-                else:
-                    slice_index = np.index_exp[zfrom:zto, ...]
-
                 with np.errstate(invalid='ignore'):
                     factor = xy_weights / sums
 
                 if sl is not None:
                     factor = factor[sl[-2::]]
 
-                slice[slice_index] *= factor
+                segments.append((int(zfrom), zstop, factor))
 
-        if debug:
-            overlay_debug(slice, index_dbg, zfrom_dbg)
-            slice[..., -2:, :] = 65000
-            slice[..., -2:] = 65000
+        if segments and segments[0][0] > 0:
+            # leading frames not covered by any overlap range
+            segments.insert(0, (0, segments[0][0], None))
+        if not segments:
+            segments = [(0, nz, None)]
 
-        output_roi_index = np.index_exp[z_from:z_to, ..., y_from:y_to,
-                                        x_from:x_to]
-        dest[output_roi_index] += slice
+        if debug:
+            # debug annotations assume a (Z, [C,] Y, X) layout; a transposed
+            # view is enough, the writes land in the same memory
+            slice_cf = np.moveaxis(slice, -1, -3) if is_cl else slice
+            for zfrom, zto, factor in segments:
+                if factor is not None:
+                    slice_cf[zfrom:zto] *= factor
+
+            overlay_debug(slice_cf, index_dbg, zfrom_dbg)
+            slice_cf[..., -2:, :] = 65000
+            slice_cf[..., -2:] = 65000
+
+            if is_cl:
+                output_roi_index = np.index_exp[z_from:z_to, y_from:y_to,
+                                                x_from:x_to]
+            else:
+                output_roi_index = np.index_exp[z_from:z_to, ...,
+                                                y_from:y_to, x_from:x_to]
+            dest[output_roi_index] += slice
+        elif numba is not None:
+            # a specialized kernel fuses multiply and accumulate into a
+            # single pass over the slice, parallelized across frames
+            for zfrom, zto, factor in segments:
+                if is_cl:
+                    d = dest[z_from + zfrom:z_from + zto,
+                             y_from:y_to, x_from:x_to]
+                else:
+                    d = dest[z_from + zfrom:z_from + zto, ...,
+                             y_from:y_to, x_from:x_to]
+                _accumulate(d, slice[zfrom:zto], factor, is_cl)
+        else:
+            # scale and accumulate one Y stripe at a time, sized so that the
+            # scaled stripe is still cache-resident when it is added to dest
+            # instead of doing two full DRAM passes over the slice
+            stripe_bytes = 2 * slice.itemsize * slice.size // frame_height
+            y_block = max(1, L3_CACHE_BYTES // stripe_bytes)
+            for zfrom, zto, factor in segments:
+                for y0 in range(0, frame_height, y_block):
+                    y1 = min(y0 + y_block, frame_height)
+                    if is_cl:
+                        s = slice[zfrom:zto, y0:y1]
+                        if factor is not None:
+                            s *= factor[y0:y1, :, np.newaxis]
+                        dest[z_from + zfrom:z_from + zto,
+                             y_from + y0:y_from + y1, x_from:x_to] += s
+                    else:
+                        s = slice[zfrom:zto, ..., y0:y1, :]
+                        if factor is not None:
+                            s *= factor[y0:y1]
+                        dest[z_from + zfrom:z_from + zto, ...,
+                             y_from + y0:y_from + y1, x_from:x_to] += s
+
+        if free_slots is not None and slot is not None:
+            free_slots.put(slot)
 
         q.task_done()
 
 
+@lru_cache(maxsize=None)
+def _digit_strip(xstr):
+    """Concatenate digit glyphs for `xstr` into a single bitmap."""
+    gap = np.zeros((canvas_shape[0], canvas_shape[1] // 2),
+                   dtype=numbers[0].dtype)
+    glyphs = flatten([[numbers[int(l)], gap] for l in xstr])
+    return np.concatenate(glyphs[:-1], axis=1)
+
+
+@lru_cache(maxsize=None)
+def _index_label(index):
+    """Concatenated glyph bitmap for all numbers appearing in `index`."""
+    strips = [_digit_strip(xstr) for xstr in re.findall(r'\d+', index)]
+    if not strips:
+        return None
+    gap = np.zeros((canvas_shape[0], canvas_shape[1]),
+                   dtype=numbers[0].dtype)
+    return np.concatenate(flatten([[s, gap] for s in strips])[:-1], axis=1)
+
+
 def overlay_debug(slice, index, z_from):
     cx = slice.shape[-1] // 2
     cy = slice.shape[-2] // 2 + 10
     x = cx - cx // 2
-    for xstr in re.findall(r'\d+', index):
-        for l in xstr:
-            x_end = x + canvas_shape[1]
-            try:
-                slice[..., cy:cy + canvas_shape[0], x:x_end] = \
-                    numbers[int(l)]
-            except ValueError:
-                break
-            x = x_end + canvas_shape[1] // 2
-        x = x_end + canvas_shape[1]
+
+    label_img = _index_label(index)
+    height = min(canvas_shape[0], slice.shape[-2] - cy)
+    if label_img is not None and height > 0:
+        width = min(label_img.shape[1], slice.shape[-1] - x)
+        # a single broadcast store, also across the leading Z axis
+        slice[..., cy:cy + height, x:x + width] = label_img[:height, :width]
 
     cy += int(canvas_shape[0] * 1.4)
-    for f in range(0, slice.shape[0]):
-        x = cx
-        xstr = str(z_from + f)
-        for l in xstr:
-            x_end = x + canvas_shape[1]
-            ie = np.index_exp[f, ..., cy:cy + canvas_shape[0], x:x_end]
-            if len(slice.shape) <= 3:
-                ie = list(ie)[1::]
-            try:
-                slice[ie] = numbers[int(l)]
-            except ValueError:
-                break
-            x = x_end + canvas_shape[1] // 2
+    height = min(canvas_shape[0], slice.shape[-2] - cy)
+    if height <= 0:
+        return
+
+    strips = [_digit_strip(str(z_from + f)) for f in range(0, slice.shape[0])]
+    width = min(max(s.shape[1] for s in strips), slice.shape[-1] - cx)
+    if width <= 0:
+        return
+
+    overlay = np.zeros((slice.shape[0], canvas_shape[0], width),
+                       dtype=numbers[0].dtype)
+    for f, s in enumerate(strips):
+        w = min(s.shape[1], width)
+        overlay[f, :, :w] = s[:, :w]
+    if len(slice.shape) > 3:
+        overlay = overlay[:, np.newaxis, ...]
+    slice[..., cy:cy + height, cx:cx + width] = overlay[:, ..., :height, :]
@@ -175,8 +175,10 @@ class FileMatrix:
 
         cols = df.columns
         if 'Xs' in cols and 'Ys' in cols and 'Zs' in cols:
-            for key in ['Xs', 'Ys', 'Zs']:
-                df[key] -= df[key].min()
+            abs_keys = ['Xs', 'Ys', 'Zs']
+            arr = df[abs_keys].to_numpy()
+            arr -= arr.min(axis=0)
+            df[abs_keys] = arr
 
         df = df.sort_values(['Z', 'Y', 'X'])
         self.compute_end_pos()
@@ -1,8 +1,7 @@
-import glob
 import os.path
 
 import numpy as np
-import skimage.external.tifffile as tiff
+import tifffile as tiff
 
 
 class TiffWrapper(object):
@@ -18,21 +17,22 @@ class TiffWrapper(object):
 
     @property
     def nfrms(self):
-        if self.axes.startswith('IYX'):
-            nfrms = self.tfile.pages[0]._shape[0]
-        else:
-            nfrms = len(self.tfile.pages)
+        series = self.tfile.series[0]
+        nfrms = 1
+        for ax, size in zip(series.axes, series.shape):
+            if ax not in 'SYXC':
+                nfrms *= size
         if self.glob_mode:
             nfrms *= len(self.flist)
         return nfrms
 
     @property
     def xsize(self):
-        return self.tfile.pages[0].image_width
+        return self.tfile.pages[0].imagewidth
 
     @property
     def ysize(self):
-        return self.tfile.pages[0].image_length
+        return self.tfile.pages[0].imagelength
 
     @property
     def axes(self):
@@ -40,10 +40,10 @@ class TiffWrapper(object):
 
     @property
     def nchannels(self):
-        if self.axes.startswith('YX') or self.axes.startswith('IYX'):
-            return self.tfile.pages[0]._shape[-1]
-        elif self.axes == 'SYX':
-            return self.tfile.pages[0]._shape[1]
+        series = self.tfile.series[0]
+        for ax, size in zip(series.axes, series.shape):
+            if ax in 'SC':
+                return size
         return 1
 
     @property
@@ -56,10 +56,12 @@ class TiffWrapper(object):
 
         if os.path.isdir(self.file_name):
             self.glob_mode = True
-            flist = []
-            flist += glob.glob(os.path.join(self.file_name, '*.tif*'))
-            flist += glob.glob(os.path.join(self.file_name, '*.TIF*'))
-            flist = sorted(flist)
+            # a single scandir pass instead of one glob per case variant
+            with os.scandir(self.file_name) as it:
+                entries = [e.name for e in it if e.is_file()
+                           and e.name.lower().endswith(('.tif', '.tiff'))]
+            flist = sorted(os.path.join(self.file_name, name)
+                           for name in entries)
             fname = flist[0]
             self.flist = flist
         else:
@@ -75,20 +77,29 @@ class TiffWrapper(object):
 
         if not self.glob_mode:
             if len(self.tfile.pages) == 1 and self.nfrms > 1:
-                a = self.tfile.asarray(0, memmap=True)
+                # contiguous file (e.g. ImageJ hyperstack): slice the whole
+                # series as a memmap, the astype below provides the copy
+                a = self.tfile.asarray(out='memmap')
                 a = a[slice(start_frame, end_frame)]
             else:
-                a = self.tfile.asarray(slice(start_frame, end_frame),
-                                       memmap=not copy)
+                a = self.tfile.asarray(key=slice(start_frame, end_frame))
         else:
             frames_per_file = self.nfrms // len(self.flist)
             start_file = start_frame // frames_per_file
             end_file = end_frame // frames_per_file
-            a = tiff.imread(self.flist[start_file:end_file], pattern='')
+            a = tiff.imread(self.flist[start_file:end_file])
+            if a.ndim > 3 and frames_per_file > 1:
+                # collapse the file axis so that frames are stacked along
+                # a single leading axis, as with single-file input
+                a = a.reshape((-1,) + a.shape[2:])
 
         if self.axes == 'SYX':
             a = np.moveaxis(a, 1, -1)
 
         if dtype is None:
             return a
-        return a.astype(dtype)
+        # astype copies unconditionally by default: skip the extra full-slab
+        # pass when the data is already materialized in a private buffer,
+        # forcing the copy only when the caller asked for one and the array
+        # still aliases the file mapping
+        return a.astype(dtype, copy=copy and isinstance(a, np.memmap))
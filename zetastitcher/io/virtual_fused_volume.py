@@ -236,7 +236,10 @@ class VirtualFusedVolume:
 
                 overlaps.loc[overlaps['Z_from'] < 0, 'Z_from'] = 0
 
-            q.put([sl_a, index, z_from, tuple(sl), top_left, overlaps])
+                cols = ['Z_from', 'Z_to', 'Y_from', 'Y_to', 'X_from', 'X_to']
+                overlaps = overlaps[cols].to_records(index=False)
+
+            q.put([sl_a, index, z_from, tuple(sl), top_left, overlaps, None])
 
         q.put(None)  # close queue
 